@@ -4,12 +4,38 @@ python convert_source_to_scribble_xdog,py "input_folder" "output_folder"
 """
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from lineart_util import scribble_xdog
 from PIL import Image
 import numpy as np
 from tqdm import tqdm
 import cv2
 
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+def load_image(image_path):
+    """
+    画像をnumpy配列として読み込みます。
+    JPEGはsimplejpeg（libjpeg-turbo）がインストールされていればそれでデコードします。
+    
+    Args:
+        image_path (str): 入力画像のパス
+        
+    Returns:
+        np.ndarray: 読み込んだ画像
+    """
+    if simplejpeg is not None and image_path.lower().endswith(('.jpg', '.jpeg')):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        # グレースケールのJPEGは1チャンネルのままデコードする
+        _, _, jpeg_colorspace, _ = simplejpeg.decode_jpeg_header(data)
+        colorspace = 'GRAY' if jpeg_colorspace == 'Gray' else 'RGB'
+        return simplejpeg.decode_jpeg(data, colorspace=colorspace)
+    return np.asarray(Image.open(image_path))
+
 def convert(image_path):
     """
     画像をスケッチに変換します。
@@ -20,8 +46,7 @@ def convert(image_path):
     Returns:
         str: 変換後の画像のパス
     """
-    image = Image.open(image_path)
-    return convert_pil_to_sketch(image)
+    return convert_np_to_sketch(load_image(image_path))
 
 def convert_pil_to_sketch(image):
     """
@@ -33,13 +58,24 @@ def convert_pil_to_sketch(image):
     Returns:
         PIL.Image: 変換後の画像
     """
-    input_width, input_height = image.size
-    image = np.array(image)
+    return convert_np_to_sketch(np.asarray(image))
+
+def convert_np_to_sketch(image):
+    """
+    numpy配列の画像をスケッチに変換します。
+    
+    Args:
+        image (np.ndarray): 入力画像
+        
+    Returns:
+        PIL.Image: 変換後の画像
+    """
+    input_height, input_width = image.shape[:2]
     processed_image, _ = scribble_xdog(image, 2048, 16)  # PIL.Image
-    processed_image = processed_image.resize((input_width, input_height))
-    # make PIL.Image to cv2 and INVERSE
-    processed_image = cv2.cvtColor(np.array(processed_image), cv2.COLOR_RGB2BGR)
-    processed_image = 255 - processed_image
+    processed_image = cv2.resize(np.asarray(processed_image), (input_width, input_height), interpolation=cv2.INTER_AREA)
+    # INVERSE (全チャンネルが同じ値のため、RGB/BGRの変換は不要)
+    # cv2.resizeの出力は新しいバッファなので、その場で反転する
+    np.subtract(255, processed_image, out=processed_image)
     return Image.fromarray(processed_image)
 
 def process_images(input_folder, output_folder):
@@ -51,22 +87,26 @@ def process_images(input_folder, output_folder):
         output_folder (str): 出力フォルダのパス
     """
     # 入力フォルダ内の全ての画像ファイルを取得
-    image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    # (os.scandirはエントリのパスを保持しているため、ファイルごとのパス結合が不要)
+    image_files = [e for e in os.scandir(input_folder) if e.name.lower().endswith(('.png', '.jpg', '.jpeg'))]
 
     # 出力フォルダを作成（存在しない場合）
     os.makedirs(output_folder, exist_ok=True)
 
-    # 各画像ファイルを処理
-    for image_file in tqdm(image_files):
-        input_path = os.path.join(input_folder, image_file)
-        output_path = os.path.join(output_folder, image_file)
+    def _work(image_file):
+        output_path = os.path.join(output_folder, image_file.name)
 
-        processed_image = convert_pil_to_sketch(Image.open(input_path))
+        processed_image = convert_np_to_sketch(load_image(image_file.path))
         processed_image.save(output_path)
 
+    # 各画像ファイルを処理（OpenCVの処理はGILを解放するため、スレッドで並列に変換する）
+    if len(image_files) == 1:
+        _work(image_files[0])
+        return
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(tqdm(executor.map(_work, image_files), total=len(image_files)))
+
 if __name__ == '__main__':
-    import argparse
-    
     parser = argparse.ArgumentParser(description='指定したフォルダ内の全ての画像をscribble_xdogで処理し、出力フォルダに保存します。')
     parser.add_argument('input_folder', type=str, help='入力フォルダのパス')
     parser.add_argument('output_folder', type=str, help='出力フォルダのパス')
@@ -8,47 +8,149 @@
 """
 
 import os
-from PIL import Image, ImageStat, ImageOps
-from collections import Counter
+import cv2
+import numpy as np
+from PIL import Image
 import random
 import math
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import argparse
 
+def _as_np(img):
+    """PIL.ImageをRGBのnumpy配列として取得する（ndarrayはそのまま返す）"""
+    if isinstance(img, np.ndarray):
+        return img
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)
+
 def get_average_color(image):
     """画像の平均色を計算する"""
-    stat = ImageStat.Stat(image)
+    arr = _as_np(image)
     # 平均色を取得（RGB）
-    r, g, b = map(int, stat.mean)
+    r, g, b = map(int, arr.reshape(-1, 3).mean(axis=0))
     return (r, g, b)
 
 def get_edge_mode_color(img, edge_width=10):
     """画像の外周の最頻値（mode）を取得する"""
-    # 外周の10ピクセル領域を取得
-    left = img.crop((0, 0, edge_width, img.height))  # 左端
-    right = img.crop((img.width - edge_width, 0, img.width, img.height))  # 右端
-    top = img.crop((0, 0, img.width, edge_width))  # 上端
-    bottom = img.crop((0, img.height - edge_width, img.width, img.height))  # 下端
+    arr = _as_np(img)
+    # 外周の10ピクセル領域（左端・右端・上端・下端）を結合
+    edges = np.concatenate([
+        arr[:, :edge_width].reshape(-1, 3),
+        arr[:, -edge_width:].reshape(-1, 3),
+        arr[:edge_width, :].reshape(-1, 3),
+        arr[-edge_width:, :].reshape(-1, 3),
+    ])
+    # RGBを1つのuint32にまとめて最頻値（mode）を計算
+    packed = (edges[:, 0].astype(np.uint32) << 16) | (edges[:, 1].astype(np.uint32) << 8) | edges[:, 2]
+    values, counts = np.unique(packed, return_counts=True)
+    mode = int(values[counts.argmax()])
 
-    # 各領域のピクセルデータを取得して結合
-    colors = list(left.getdata()) + list(right.getdata()) + list(top.getdata()) + list(bottom.getdata())
-    # 最頻値（mode）を計算
-    mode_color = Counter(colors).most_common(1)[0][0]  # 最も頻繁に出現する色を取得
+    return ((mode >> 16) & 0xFF, (mode >> 8) & 0xFF, mode & 0xFF)
 
-    return mode_color
+def get_fill_color(image, is_avg_color_fill=False, is_edge_mode_fill=False):
+    """余白を埋める色を決定する（外周の最頻値 > 平均色 > 白の優先順）"""
+    if is_edge_mode_fill:
+        return get_edge_mode_color(image, edge_width=10)
+    if is_avg_color_fill:
+        return get_average_color(image)
+    return (255, 255, 255)
 
 def rotate_image(image, angle, fill_color=(255, 255, 255)):
     """画像を指定された角度で回転させ、指定された色で余白を埋める"""
-    return image.rotate(angle, expand=True, fillcolor=fill_color)
+    arr = _as_np(image)
+    height, width = arr.shape[:2]
+    M = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+    # 回転後の画像全体が収まるようにキャンバスを拡張（expand=True相当）
+    cos, sin = abs(M[0, 0]), abs(M[0, 1])
+    new_width = int(round(height * sin + width * cos))
+    new_height = int(round(height * cos + width * sin))
+    M[0, 2] += (new_width - width) / 2
+    M[1, 2] += (new_height - height) / 2
+    rotated = cv2.warpAffine(
+        arr, M, (new_width, new_height),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=fill_color
+    )
+    return rotated
+
+def expand_canvas(image, canvas_width, canvas_height, fill_color=(255, 255, 255)):
+    """画像を中央に配置したまま指定サイズのキャンバスに拡張し、指定された色で余白を埋める"""
+    arr = _as_np(image)
+    height, width = arr.shape[:2]
+    top = (canvas_height - height) // 2
+    bottom = canvas_height - height - top
+    left = (canvas_width - width) // 2
+    right = canvas_width - width - left
+    return cv2.copyMakeBorder(arr, top, bottom, left, right, cv2.BORDER_CONSTANT, value=fill_color)
+
+def crop_from_canvas(image, canvas_width, canvas_height, left, top, crop_size, output_size, fill_color=(255, 255, 255), dst=None):
+    """
+    画像を中央に配置したキャンバスから正方形を切り出してリサイズする処理を、
+    キャンバスを作成せずに1回のwarpAffineで行う（dstを指定した場合はそこに書き込む）
+    """
+    height, width = image.shape[:2]
+    offset_x = (canvas_width - width) // 2
+    offset_y = (canvas_height - height) // 2
+    scale_x = output_size[0] / crop_size
+    scale_y = output_size[1] / crop_size
+    # 切り出し範囲のうち画像と重なる部分だけを使う（キャンバス上の原点をその分ずらす）
+    x0, x1 = max(left - offset_x, 0), min(left + crop_size - offset_x, width)
+    y0, y1 = max(top - offset_y, 0), min(top + crop_size - offset_y, height)
+    if x0 >= x1 or y0 >= y1:
+        # 切り出し範囲が余白のみの場合
+        if dst is None:
+            dst = np.empty((output_size[1], output_size[0], 3), dtype=np.uint8)
+        dst[...] = fill_color
+        return dst
+    image = image[y0:y1, x0:x1]
+    height, width = image.shape[:2]
+    offset_x += x0
+    offset_y += y0
+    # 大きく縮小する場合は、先にINTER_AREAで縮小してエイリアシングを防ぐ
+    ratio_x = ratio_y = 1.0
+    if max(scale_x, scale_y) < 1.0:
+        resized_width = max(1, int(round(width * scale_x)))
+        resized_height = max(1, int(round(height * scale_y)))
+        image = cv2.resize(image, (resized_width, resized_height), interpolation=cv2.INTER_AREA)
+        ratio_x = resized_width / width
+        ratio_y = resized_height / height
+    # 画像座標 -> キャンバス座標 -> 切り出し座標 -> 出力座標 の変換を1つの行列にまとめる（ピクセル中心基準）
+    M = np.array([
+        [scale_x / ratio_x, 0, (0.5 / ratio_x + offset_x - left) * scale_x - 0.5],
+        [0, scale_y / ratio_y, (0.5 / ratio_y + offset_y - top) * scale_y - 0.5],
+    ])
+    return cv2.warpAffine(
+        image, M, output_size,
+        dst=dst,
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=fill_color
+    )
 
 def crop_square(cropped_rect_image, left, top, crop_size):
     """ランダムな正方形を切り出す"""
-    return cropped_rect_image.crop((left, top, left + crop_size, top + crop_size))
+    cropped = cropped_rect_image[top:top + crop_size, left:left + crop_size]
+    # 画像の範囲外にはみ出した部分は黒で埋める（PIL.Image.cropと同じ挙動）
+    height, width = cropped.shape[:2]
+    if height < crop_size or width < crop_size:
+        cropped = cv2.copyMakeBorder(cropped, 0, crop_size - height, 0, crop_size - width, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+    return cropped
+
+def resize_image(image, output_size, dst=None):
+    """
+    画像を指定されたサイズにリサイズする（縮小時はINTER_AREA、拡大時はINTER_LINEAR）
+    dstを指定した場合はそこに書き込む
+    """
+    interpolation = cv2.INTER_AREA if image.shape[1] > output_size[0] else cv2.INTER_LINEAR
+    return cv2.resize(image, output_size, dst=dst, interpolation=interpolation)
 
 def apply_random_flip(image, is_horizontal):
     """画像にランダムなフリップ（水平または垂直）を適用する"""
     if is_horizontal:
-        return ImageOps.mirror(image)  # 水平フリップ
+        return image[:, ::-1]  # 水平フリップ（コピーせずにビューを返す）
     return image
 
 def process_image_pair(
@@ -63,97 +165,110 @@ def process_image_pair(
     source_is_edge_mode_fill=False,
     target_is_avg_color_fill=True,
     target_is_edge_mode_fill=False,
-    expand_to_long_side=False
+    expand_to_long_side=False,
+    source_fill_color=None,
+    target_fill_color=None,
+    angle=None,
+    is_horizontal=None,
+    scale=None,
+    crop_position=None,
+    source_dst=None,
+    target_dst=None,
+    return_arrays=False
     ):
-    """1組の画像に対して拡張処理を行う"""
-    orig_source_width, orig_source_height = source_image.size
-    orig_target_width, orig_target_height = target_image.size
+    """
+    1組の画像に対して拡張処理を行う
+    source_fill_color, target_fill_colorを指定した場合は余白の色の計算を省略する
+    angle, is_horizontal, scale, crop_position（切り出し位置の割合(x, y), 0以上1未満）を
+    指定した場合はその値を使い、指定しない場合はランダムに決定する
+    source_dst, target_dst（output_sizeのuint8配列）を指定した場合は最終結果をそこに書き込む
+    return_arrays=Trueの場合はPIL.Imageに変換せず、numpy配列のまま返す
+    """
+    # 最初にnumpy配列へ変換し、以降の処理はすべて配列上で行う
+    source_image = _as_np(source_image)
+    target_image = _as_np(target_image)
+    orig_source_height, orig_source_width = source_image.shape[:2]
+    orig_target_height, orig_target_width = target_image.shape[:2]
     
     # ソース画像の余白の色を決定
-    if source_is_edge_mode_fill:
-        source_fill_color = get_edge_mode_color(source_image, edge_width=10)
-    elif source_is_avg_color_fill:
-        source_fill_color = get_average_color(source_image)
-    else:
-        source_fill_color = (255, 255, 255)
+    if source_fill_color is None:
+        source_fill_color = get_fill_color(source_image, source_is_avg_color_fill, source_is_edge_mode_fill)
     
     # ターゲット画像の余白の色を決定
-    if target_is_edge_mode_fill:
-        target_fill_color = get_edge_mode_color(target_image, edge_width=10)
-    elif target_is_avg_color_fill:
-        target_fill_color = get_average_color(target_image)
-    else:
-        target_fill_color = (255, 255, 255)
+    if target_fill_color is None:
+        target_fill_color = get_fill_color(target_image, target_is_avg_color_fill, target_is_edge_mode_fill)
 
     base_source = source_image
     base_target = target_image
 
     # 長辺を基準にする場合の処理を追加
     if expand_to_long_side:
-        # sourceの長辺を取得して正方形のキャンバスを作成
-        source_long_side = max(base_source.width, base_source.height)
-        source_canvas = Image.new("RGB", (source_long_side, source_long_side), source_fill_color)
-        # 中央に配置
-        source_paste_x = (source_long_side - base_source.width) // 2
-        source_paste_y = (source_long_side - base_source.height) // 2
-        source_canvas.paste(base_source, (source_paste_x, source_paste_y))
-        base_source = source_canvas
+        # sourceの長辺を取得して正方形のキャンバスを作成し、中央に配置
+        source_long_side = max(base_source.shape[:2])
+        base_source = expand_canvas(base_source, source_long_side, source_long_side, source_fill_color)
 
         # targetも同様に処理
-        target_long_side = max(base_target.width, base_target.height)
-        target_canvas = Image.new("RGB", (target_long_side, target_long_side), target_fill_color)
-        target_paste_x = (target_long_side - base_target.width) // 2
-        target_paste_y = (target_long_side - base_target.height) // 2
-        target_canvas.paste(base_target, (target_paste_x, target_paste_y))
-        base_target = target_canvas
+        target_long_side = max(base_target.shape[:2])
+        base_target = expand_canvas(base_target, target_long_side, target_long_side, target_fill_color)
 
     if rotation_range > 0:
-        angle = random.uniform(-rotation_range, rotation_range)
+        if angle is None:
+            angle = random.uniform(-rotation_range, rotation_range)
         rotated_source = rotate_image(source_image, angle, source_fill_color)
         rotated_target = rotate_image(target_image, angle, target_fill_color)
         base_source = rotated_source
         base_target = rotated_target
 
     if is_flip:
-        is_horizontal = random.choice([True, False])
+        if is_horizontal is None:
+            is_horizontal = random.choice([True, False])
         flipped_source = apply_random_flip(base_source, is_horizontal)
         flipped_target = apply_random_flip(base_target, is_horizontal)
         base_source = flipped_source
         base_target = flipped_target
 
-    scale = random.uniform(min_scale, max_scale)
+    if scale is None:
+        scale = random.uniform(min_scale, max_scale)
     canvas_scale = 1/scale
 
-    if canvas_scale > 1.0:
-        # 新規画像(canvas)を作成し中心に画像を配置
-        scaled_source = Image.new("RGB", (int(base_source.width*canvas_scale), int(base_source.height*canvas_scale)), source_fill_color)
-        scaled_target = Image.new("RGB", (int(base_target.width*canvas_scale), int(base_target.height*canvas_scale)), target_fill_color)
-        scaled_source.paste(base_source, (int((scaled_source.width-base_source.width)/2), int((scaled_source.height-base_source.height)/2)))
-        scaled_target.paste(base_target, (int((scaled_target.width-base_target.width)/2), int((scaled_target.height-base_target.height)/2)))
-    else:
-        scaled_source = base_source
-        scaled_target = base_target
-
-    base_source_width, base_source_height = base_source.size
+    base_source_height, base_source_width = base_source.shape[:2]
     base_source_max_square_size = min(base_source_height, base_source_width)
     crop_source_size = int(base_source_max_square_size * canvas_scale)
 
-    base_target_width, base_target_height = base_target.size
+    base_target_height, base_target_width = base_target.shape[:2]
     base_target_max_square_size = min(base_target_height, base_target_width)
     crop_target_size = int(base_target_max_square_size * canvas_scale)
 
-    scaled_source_width, scaled_source_height = scaled_source.size
-    left_source = random.randint(0, scaled_source_width - crop_source_size)
-    top_source = random.randint(0, scaled_source_height - crop_source_size)
+    if canvas_scale > 1.0:
+        # 中心に画像を配置した新規画像(canvas)のサイズ（canvas自体は作成しない）
+        scaled_source_width, scaled_source_height = int(base_source_width*canvas_scale), int(base_source_height*canvas_scale)
+        scaled_target_width, scaled_target_height = int(base_target_width*canvas_scale), int(base_target_height*canvas_scale)
+    else:
+        scaled_source_width, scaled_source_height = base_source_width, base_source_height
+        scaled_target_width, scaled_target_height = base_target_width, base_target_height
+
+    if crop_position is None:
+        left_source = random.randint(0, scaled_source_width - crop_source_size)
+        top_source = random.randint(0, scaled_source_height - crop_source_size)
+    else:
+        left_source = int(crop_position[0] * (scaled_source_width - crop_source_size + 1))
+        top_source = int(crop_position[1] * (scaled_source_height - crop_source_size + 1))
 
     # sourceとtargetの位置合わせ. この場合、sourceとtargetのアスペクト比は同じと仮定
     left_target = left_source * orig_target_width // orig_source_width
     top_target = top_source * orig_target_height // orig_source_height
 
-    final_source = crop_square(scaled_source, left_source, top_source, crop_source_size).resize(output_size)
-    final_target = crop_square(scaled_target, left_target, top_target, crop_target_size).resize(output_size)
+    if canvas_scale > 1.0:
+        final_source = crop_from_canvas(base_source, scaled_source_width, scaled_source_height, left_source, top_source, crop_source_size, output_size, source_fill_color, dst=source_dst)
+        final_target = crop_from_canvas(base_target, scaled_target_width, scaled_target_height, left_target, top_target, crop_target_size, output_size, target_fill_color, dst=target_dst)
+    else:
+        final_source = resize_image(crop_square(base_source, left_source, top_source, crop_source_size), output_size, dst=source_dst)
+        final_target = resize_image(crop_square(base_target, left_target, top_target, crop_target_size), output_size, dst=target_dst)
 
-    return final_source, final_target
+    if return_arrays:
+        return final_source, final_target
+    # PIL.Imageへの変換は最後に1回だけ行う
+    return Image.fromarray(final_source), Image.fromarray(final_target)
 
 def process_images(
     source_img,
@@ -168,14 +283,18 @@ def process_images(
     source_is_edge_mode_fill,
     target_is_avg_color_fill,
     target_is_edge_mode_fill,
-    expand_to_long_side
+    expand_to_long_side,
+    seed=None,
+    return_arrays=False
 ):
-    aug_sources = []
-    aug_targets = []
-    
-    for i in range(num_copies):
+    """
+    1組の画像からnum_copies組の拡張画像を生成する
+    return_arrays=Trueの場合は、全コピー分を連続して確保した出力バッファへ直接書き込み、
+    そのビュー（numpy配列）を返す（PIL.Imageへの変換によるコピーが発生しない）
+    """
+    def _work(i):
         # 拡張処理を実行
-        aug_source, aug_target = process_image_pair(
+        return process_image_pair(
             source_img,
             target_img,
             output_size,
@@ -187,11 +306,50 @@ def process_images(
             source_is_edge_mode_fill,
             target_is_avg_color_fill,
             target_is_edge_mode_fill,
-            expand_to_long_side
+            expand_to_long_side,
+            source_fill_color=source_fill_color,
+            target_fill_color=target_fill_color,
+            angle=float(angles[i]),
+            is_horizontal=bool(flips[i]),
+            scale=float(scales[i]),
+            crop_position=crop_positions[i],
+            source_dst=out_sources[i] if return_arrays else None,
+            target_dst=out_targets[i] if return_arrays else None,
+            return_arrays=return_arrays
         )
-        
-        aug_sources.append(aug_source)
-        aug_targets.append(aug_target)
+
+    if num_copies <= 0:
+        return [], []
+
+    # スレッド間で共有する前に一度だけnumpy配列へ変換しておく
+    source_img = _as_np(source_img)
+    target_img = _as_np(target_img)
+    # 余白の色は元画像のみから決まるため、全コピーで共通の値を1回だけ計算する
+    source_fill_color = get_fill_color(source_img, source_is_avg_color_fill, source_is_edge_mode_fill)
+    target_fill_color = get_fill_color(target_img, target_is_avg_color_fill, target_is_edge_mode_fill)
+
+    # 全コピー分のランダムなパラメータをまとめて生成する（seedを指定すると再現可能）
+    rng = np.random.default_rng(seed)
+    angles = rng.uniform(-rotation_range, rotation_range, num_copies)
+    flips = rng.integers(0, 2, num_copies).astype(bool)
+    scales = rng.uniform(min_scale, max_scale, num_copies)
+    crop_positions = rng.random((num_copies, 2))
+
+    # 配列で返す場合は、全コピー分の出力バッファを連続したメモリとして確保しておく
+    # (PIL.Imageで返す場合は変換時にコピーされるため確保しない)
+    if return_arrays:
+        out_sources = np.empty((num_copies, output_size[1], output_size[0], 3), dtype=np.uint8)
+        out_targets = np.empty((num_copies, output_size[1], output_size[0], 3), dtype=np.uint8)
+
+    # OpenCV/NumPyの処理はGILを解放するため、スレッドで並列に拡張する
+    if num_copies == 1:
+        results = [_work(i) for i in range(num_copies)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(num_copies, os.cpu_count() or 1)) as executor:
+            results = list(executor.map(_work, range(num_copies)))
+
+    aug_sources = [aug_source for aug_source, _ in results]
+    aug_targets = [aug_target for _, aug_target in results]
     
     return aug_sources, aug_targets
 
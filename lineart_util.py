@@ -2,6 +2,11 @@ import cv2
 import numpy as np
 from PIL import Image
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 def pad64(x):
     return int(np.ceil(float(x) / 64.0) * 64 - x)
 
@@ -25,31 +30,101 @@ def HWC3(x):
 
 def safer_memory(x):
     # Fix many MAC/AMD problems
-    return np.ascontiguousarray(x.copy()).copy()
+    # 連続メモリでない場合のみコピーする
+    return np.ascontiguousarray(x)
 
-def resize_image_with_pad(input_image, resolution, skip_hwc3=False):
+def resize_image_with_pad(input_image, resolution, skip_hwc3=False, keep_gray=False):
     if skip_hwc3:
         img = input_image
+    elif keep_gray and (input_image.ndim == 2 or input_image.shape[2] == 1):
+        # グレースケールは3チャンネルに展開せず2次元のまま扱う
+        assert input_image.dtype == np.uint8
+        img = input_image.reshape(input_image.shape[:2])
     else:
         img = HWC3(input_image)
-    H_raw, W_raw, _ = img.shape
+    H_raw, W_raw = img.shape[:2]
     k = float(resolution) / float(min(H_raw, W_raw))
     interpolation = cv2.INTER_CUBIC if k > 1 else cv2.INTER_AREA
     H_target = int(np.round(float(H_raw) * k))
     W_target = int(np.round(float(W_raw) * k))
     img = cv2.resize(img, (W_target, H_target), interpolation=interpolation)
     H_pad, W_pad = pad64(H_target), pad64(W_target)
-    img_padded = np.pad(img, [[0, H_pad], [0, W_pad], [0, 0]], mode='edge')
+    img_padded = np.pad(img, [[0, H_pad], [0, W_pad]] + [[0, 0]] * (img.ndim - 2), mode='edge')
 
     def remove_pad(x):
         return safer_memory(x[:H_target, :W_target])
 
     return safer_memory(img_padded), remove_pad
 
+# scribble_xdogで使うガウシアンカーネルを事前に計算しておく
+# (cv2.GaussianBlurがfloat32入力で自動的に選ぶカーネルサイズと同じ)
+# ぼかしはint16の固定小数点（1/16階調）で計算するため、水平方向のカーネルを16倍しておく
+_XDOG_FIXED_SCALE = 16
+_XDOG_KERNEL_FINE = cv2.getGaussianKernel(5, 0.5, cv2.CV_32F)
+_XDOG_KERNEL_COARSE = cv2.getGaussianKernel(41, 5.0, cv2.CV_32F)
+_XDOG_KERNEL_FINE = (_XDOG_KERNEL_FINE * _XDOG_FIXED_SCALE, _XDOG_KERNEL_FINE)
+_XDOG_KERNEL_COARSE = (_XDOG_KERNEL_COARSE * _XDOG_FIXED_SCALE, _XDOG_KERNEL_COARSE)
+# タイル分割時に必要な重なり幅（最大のカーネル半径）
+_XDOG_HALO = _XDOG_KERNEL_COARSE[1].shape[0] // 2
+
+def _blur(img, k):
+    # uint8入力を16倍したint16で出力する（最大 255 * 16 = 4080）
+    return cv2.sepFilter2D(img, cv2.CV_16S, k[0], k[1])
+
+if njit is not None:
+    # parallel=Trueの並列カーネルは複数スレッドから呼び出すとハングする場合があるため、
+    # GILを解放する単一スレッドのカーネルとし、並列化は呼び出し側のスレッドに任せる
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _xdog_fuse(g1, g2, thr_a, out):
+        # g2 - g1 のチャンネル方向の最小値を閾値処理する（1パスで処理）
+        H, W, C = g1.shape
+        for y in range(H):
+            for x in range(W):
+                m = np.int32(g2[y, x, 0]) - np.int32(g1[y, x, 0])
+                for c in range(1, C):
+                    d = np.int32(g2[y, x, c]) - np.int32(g1[y, x, c])
+                    if d < m:
+                        m = d
+                out[y, x] = 255 if 2 * m > thr_a else 0
+else:
+    def _xdog_fuse(g1, g2, thr_a, out):
+        # numbaが無い場合はNumPyで処理する
+        dog = cv2.subtract(g2, g1).reshape(g1.shape).min(axis=2)
+        out[...] = (2 * dog.astype(np.int32) > thr_a) * 255
+
+def _xdog_tiled(img, thr_a, tile=512, halo=_XDOG_HALO):
+    """
+    画像をタイルに分割してXDoGを計算する
+    タイルごとの作業領域をキャッシュに収めるため、周囲にhaloピクセルの重なりを持たせて処理する
+    """
+    H, W = img.shape[:2]
+    result = np.empty((H, W), dtype=np.uint8)
+    for y in range(0, H, tile):
+        for x in range(0, W, tile):
+            y0, x0 = max(y - halo, 0), max(x - halo, 0)
+            y1, x1 = min(y + tile + halo, H), min(x + tile + halo, W)
+            # ぼかしはint16の固定小数点で計算する（float32の1/2の帯域）
+            f = img[y0:y1, x0:x1]
+            g1 = _blur(f, _XDOG_KERNEL_FINE)
+            g2 = _blur(f, _XDOG_KERNEL_COARSE)
+            if g1.ndim == 2:
+                # グレースケールは1チャンネルとして扱う（ビューのためコピーは発生しない）
+                g1, g2 = g1[:, :, None], g2[:, :, None]
+            # haloを除いた中央部分のみを出力に書き込む
+            th, tw = min(tile, H - y), min(tile, W - x)
+            cy, cx = y - y0, x - x0
+            _xdog_fuse(
+                g1[cy:cy + th, cx:cx + tw],
+                g2[cy:cy + th, cx:cx + tw],
+                thr_a * _XDOG_FIXED_SCALE,
+                result[y:y + th, x:x + tw]
+            )
+    return result
+
 def scribble_xdog(img, res=512, thr_a=32, **kwargs):
     """
     XDoGを使ってスケッチ画像を生成する
-    :param img: np.ndarray, 入力画像
+    :param img: np.ndarray, 入力画像（グレースケールは2次元のまま処理する）
     :param res: int, 出力画像の解像度
     :param thr_a: int, 閾値
 
@@ -57,11 +132,8 @@ def scribble_xdog(img, res=512, thr_a=32, **kwargs):
     -------
     Image : PIL.Image
     """
-    img, remove_pad = resize_image_with_pad(img, res)
-    g1 = cv2.GaussianBlur(img.astype(np.float32), (0, 0), 0.5)
-    g2 = cv2.GaussianBlur(img.astype(np.float32), (0, 0), 5.0)
-    dog = (255 - np.min(g2 - g1, axis=2)).clip(0, 255).astype(np.uint8)
-    result = np.zeros_like(img, dtype=np.uint8)
-    result[2 * (255 - dog) > thr_a] = 255
-    result = Image.fromarray(remove_pad(result))
+    img, remove_pad = resize_image_with_pad(img, res, keep_gray=True)
+    result = remove_pad(_xdog_tiled(img, thr_a))
+    # 1チャンネルのまま計算し、最後に3チャンネルへ展開する
+    result = Image.fromarray(np.broadcast_to(result[:, :, None], result.shape + (3,)))
     return result, True
@@ -30,7 +30,7 @@ def process_multiple_images(
         source_img = Image.open(source_path.name)
         target_img = Image.open(target_path.name)
         
-        # 拡張処理を実行し、PILイメージのリストを取得
+        # 拡張処理を実行し、numpy配列のリストを取得
         aug_sources, aug_targets = process_images(
             source_img,
             target_img,
@@ -44,7 +44,8 @@ def process_multiple_images(
             source_is_edge_mode_fill=source_is_edge_mode_fill,
             target_is_avg_color_fill=target_is_avg_color_fill,
             target_is_edge_mode_fill=target_is_edge_mode_fill,
-            expand_to_long_side=expand_to_long_side
+            expand_to_long_side=expand_to_long_side,
+            return_arrays=True  # Galleryはnumpy配列をそのまま表示できるため、PIL.Imageへの変換を省く
         )
         
         # 生成された画像を収集
@@ -54,18 +55,10 @@ def process_multiple_images(
     return result_source_images, result_target_images
 
 def update_source_preview(source_files):
-    preview_images = []
-    if source_files:
-        for source in source_files:
-            preview_images.append(source.name)
-    return preview_images
+    return [source.name for source in source_files] if source_files else []
 
 def update_target_preview(target_files):
-    preview_images = []
-    if target_files:
-        for target in target_files:
-            preview_images.append(target.name)
-    return preview_images
+    return [target.name for target in target_files] if target_files else []
 
 def convert_to_sketch(source_files):
     """sourceをスケッチに変換"""
@@ -80,8 +73,9 @@ def convert_to_sketch(source_files):
                 sketch = convert_source_to_sketch.convert_pil_to_sketch(image)
                 
                 # 一時ファイルとして保存
+                # (全チャンネルが同じ値のため1チャンネルで保存し、PNGは圧縮レベルを下げてエンコードを軽くする)
                 temp_path = os.path.join(temp_dir, os.path.basename(source.name))
-                sketch.save(temp_path)
+                sketch.convert("L").save(temp_path, compress_level=1)
                 converted_images.append(temp_path)
         except Exception as e:
             print(f"Error during conversion: {e}")